@@ -1,17 +1,58 @@
 #!/usr/bin/env python3
 import os
 import sys
+import time
+import shutil
+import functools
 import logging
+import queue
+import socket
+import ipaddress
 import subprocess
+import tempfile
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import random
 import yaml
 import argparse
-from typing import Dict, Optional
+import diskcache
+from typing import Dict, List, Optional
+
+try:
+    # Prefer the libyaml C emitter when PyYAML was built with it
+    from yaml import CSafeDumper
+except ImportError:
+    from yaml import SafeDumper as CSafeDumper
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('nanda_sdk')
 
+# Only these HTTP statuses can succeed on a later attempt; any other 4xx is terminal
+RETRYABLE_STATUS_CODES = (408, 425, 429, 500, 502, 503, 504)
+
+# Detected public IPs are cached on disk; failures are cached briefly so repeated runs during an outage back off
+IP_CACHE_DIR = os.path.expanduser("~/.cache/nanda-sdk")
+IP_CACHE_TTL = 3600
+IP_CACHE_FAILURE_TTL = 30
+
+
+@functools.lru_cache(maxsize=1)
+def _find_ansible_playbook() -> Optional[str]:
+    """Locate the ansible-playbook executable, searching PATH before common install locations
+
+    The result is memoized for the life of the process; call _find_ansible_playbook.cache_clear() to search again.
+    """
+    possible_locations = [
+        # pip installs console scripts next to the running interpreter, which may not be on PATH
+        os.path.join(os.path.dirname(sys.executable), "ansible-playbook"),
+        os.path.expanduser("~/.local/bin/ansible-playbook"),
+        "/usr/local/bin/ansible-playbook",
+        "/usr/bin/ansible-playbook"
+    ]
+    return shutil.which("ansible-playbook") or next(
+        (p for p in possible_locations if os.path.isfile(p) and os.access(p, os.X_OK)), None)
 
 
 class NandaSdk:
@@ -19,7 +60,8 @@ class NandaSdk:
                  domain: str,
                  num_agents: int,
                  registry_url: str = "https://chat.nanda-registry.com:6900",
-                 agent_id: Optional[int] = None):
+                 agent_id: Optional[int] = None,
+                 use_ip_cache: bool = True):
         """
         Initialize NANDA SDK
         
@@ -28,11 +70,14 @@ class NandaSdk:
             num_agents: Number of agents to set up
             registry_url: URL of the NANDA registry (default: https://chat.nanda-registry.com)
             agent_id: Agent ID number (if None, a random 6-digit number will be generated)
+            use_ip_cache: Reuse a previously detected public IP instead of probing again
         """
         self.domain = domain
         self.agent_id = agent_id if agent_id is not None else self._generate_agent_id()
         self.num_agents = num_agents
         self.registry_url = registry_url
+        self.use_ip_cache = use_ip_cache
+        self.session = self._create_session()
         logger.info(f"Using agent ID: {self.agent_id}")
         logger.info(f"Using domain: {self.domain}")
         logger.info(f"Using num_agents: {self.num_agents}")
@@ -42,34 +87,183 @@ class NandaSdk:
         """Generate a random 6-digit agent ID"""
         return random.randint(100000, 999999)
 
+    def _create_session(self) -> requests.Session:
+        """Create a pooled HTTP session; retries are left to _retry so attempts and wall time stay bounded"""
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(max_retries=Retry(total=0)))
+        return session
+
+    @staticmethod
+    def _is_retryable_error(error: Exception) -> bool:
+        """Return True if a failed request may succeed when retried"""
+        if isinstance(error, requests.HTTPError) and error.response is not None:
+            return error.response.status_code in RETRYABLE_STATUS_CODES
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+    @staticmethod
+    def _get_retry_after(error: Exception) -> float:
+        """Return the delay requested by a Retry-After header, if any"""
+        response = getattr(error, "response", None)
+        if response is None:
+            return 0
+        try:
+            return max(0, int(response.headers.get("Retry-After", 0)))
+        except ValueError:
+            return 0
+
+    def _retry(self, fn, max_attempts: int = 3, base: float = 0.5, cap: float = 4.0, budget: float = 8.0,
+               deadline: Optional[float] = None, stop: Optional[threading.Event] = None):
+        """Call fn, retrying retryable failures with capped exponential backoff and full jitter
+
+        fn receives the seconds left in the budget and must not block longer than that.
+        Retrying ends early at an absolute monotonic deadline, or once stop is set.
+        """
+        budget_deadline = time.monotonic() + budget
+        deadline = budget_deadline if deadline is None else min(deadline, budget_deadline)
+        for attempt in range(max_attempts):
+            if deadline - time.monotonic() <= 0:
+                raise requests.Timeout("Retry deadline exceeded")
+            try:
+                return fn(deadline - time.monotonic())
+            except Exception as e:
+                if attempt == max_attempts - 1 or not self._is_retryable_error(e):
+                    raise
+                delay = random.uniform(0, min(cap, base * 2 ** attempt))
+                delay = max(delay, self._get_retry_after(e))
+                if time.monotonic() + delay >= deadline:
+                    raise
+                logger.warning(f"Attempt {attempt + 1} failed: {str(e)}; retrying in {delay:.1f}s")
+                if stop is None:
+                    time.sleep(delay)
+                elif stop.wait(delay):
+                    raise
+
+    def _request_with_retry(self, url: str, timeout: tuple = (2, 3), deadline: Optional[float] = None,
+                            stop: Optional[threading.Event] = None, **kwargs) -> requests.Response:
+        """Send a GET request, retrying transient failures and raising on HTTP errors"""
+        def request(remaining: float) -> requests.Response:
+            # Never let a single attempt run past the retry budget
+            connect_timeout, read_timeout = (min(t, remaining) for t in timeout)
+            response = self.session.get(url, timeout=(connect_timeout, read_timeout), **kwargs)
+            try:
+                response.raise_for_status()
+            except requests.HTTPError as e:
+                response.close()
+                if not self._is_retryable_error(e):
+                    logger.warning(f"Not retrying {url}: HTTP {e.response.status_code} cannot succeed on retry")
+                raise
+            return response
+
+        return self._retry(request, deadline=deadline, stop=stop)
+
+    def _probe_ip_service(self, service: str, deadline: Optional[float] = None,
+                          stop: Optional[threading.Event] = None) -> str:
+        """Fetch and validate the public IP reported by a single service"""
+        response = self._request_with_retry(service, timeout=(2, 3), deadline=deadline, stop=stop, stream=True)
+        with response:
+            # An IP address is at most 45 characters; don't download a whole captive-portal page
+            body = response.raw.read(64, decode_content=True)
+        ip = body.decode("utf-8", errors="replace").strip()
+        try:
+            ipaddress.ip_address(ip)
+        except ValueError:
+            raise ValueError(f"Response is not an IP address: {ip[:32]!r}")
+        return ip
+
+    def _get_ip_from_socket(self) -> Optional[str]:
+        """Fall back to the address of the outbound interface if it is publicly routable"""
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+                # connect() on a UDP socket sends no packets, it only selects a route
+                s.connect(("8.8.8.8", 80))
+                ip = s.getsockname()[0]
+        except OSError as e:
+            logger.warning(f"Failed to get IP from local socket: {str(e)}")
+            return None
+        if not ipaddress.ip_address(ip).is_global:
+            logger.warning(f"Local interface address {ip} is not publicly routable")
+            return None
+        return ip
+
     def get_public_ip(self) -> str:
-        """Get the server's public IP address"""
+        """Get the server's public IP address, using the on-disk cache when possible"""
+        cache_key = f"public_ip:{socket.gethostname()}"
+        try:
+            cache = diskcache.Cache(IP_CACHE_DIR)
+        except Exception as e:
+            logger.warning(f"IP cache unavailable: {str(e)}")
+            return self._detect_public_ip()
+
+        with cache:
+            if self.use_ip_cache:
+                cached_ip = cache.get(cache_key)
+                if cached_ip == "":
+                    raise Exception("Public IP detection failed recently; retry shortly or pass --no-ip-cache")
+                if cached_ip:
+                    logger.info(f"Using cached public IP: {cached_ip}")
+                    return cached_ip
+
+            try:
+                ip = self._detect_public_ip()
+            except Exception:
+                cache.set(cache_key, "", expire=IP_CACHE_FAILURE_TTL)
+                raise
+            cache.set(cache_key, ip, expire=IP_CACHE_TTL)
+            return ip
+
+    def _detect_public_ip(self) -> str:
+        """Detect the server's public IP address"""
         try:
-            # Try multiple IP detection services in case one fails
+            # Query multiple IP detection services concurrently and take the first valid answer
             ip_services = [
                 "https://api.ipify.org",
                 "https://ifconfig.me/ip",
                 "https://icanhazip.com"
             ]
-            
-            for service in ip_services:
+
+            # Every probe shares one deadline and stops retrying once a winner is found
+            deadline = time.monotonic() + 6
+            stop = threading.Event()
+            results = queue.Queue()
+
+            def probe(service: str) -> None:
                 try:
-                    response = requests.get(service, timeout=5)
-                    if response.status_code == 200:
-                        ip = response.text.strip()
-                        logger.info(f"Successfully detected public IP: {ip}")
-                        return ip
+                    results.put((service, self._probe_ip_service(service, deadline, stop), None))
                 except Exception as e:
-                    logger.warning(f"Failed to get IP from {service}: {str(e)}")
-                    continue
-            
+                    results.put((service, None, e))
+
+            # Daemon threads, so a probe still in flight can never delay interpreter exit
+            for service in ip_services:
+                threading.Thread(target=probe, args=(service,), daemon=True).start()
+
+            try:
+                for _ in ip_services:
+                    service, ip, error = results.get(timeout=max(0, deadline - time.monotonic()))
+                    if error is not None:
+                        logger.warning(f"Failed to get IP from {service}: {str(error)}")
+                        continue
+                    logger.info(f"Successfully detected public IP: {ip}")
+                    return ip
+            except queue.Empty:
+                logger.warning("Timed out waiting for IP detection services")
+            finally:
+                stop.set()
+
+            ip = self._get_ip_from_socket()
+            if ip:
+                logger.info(f"Detected public IP from local interface: {ip}")
+                return ip
+
             raise Exception("Failed to detect public IP from any service")
         except Exception as e:
             logger.error(f"Failed to get public IP: {str(e)}")
             raise
 
-    def create_ansible_inventory(self) -> str:
-        """Create Ansible inventory file"""
+    def create_ansible_inventory(self, directory: Optional[str] = None) -> str:
+        """Create Ansible inventory file in the given directory, or in a new temporary one if None
+
+        A directory created here is not removed automatically; the caller owns it.
+        """
         # Get server's public IP
         server_ip = self.get_public_ip()
         
@@ -85,84 +279,123 @@ agent_id_prefix={self.agent_id}
 github_repo=https://github.com/aidecentralized/nanda-agent.git
 registry_url={self.registry_url}
 """
-        inventory_path = "/tmp/ioa_inventory.ini"
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="ioa_")
+        inventory_path = os.path.join(directory, "inventory.ini")
         with open(inventory_path, "w") as f:
             f.write(inventory_content)
         return inventory_path
 
     def setup_server(self, anthropic_api_key: str, smithery_api_key: str, verbose: bool = False) -> bool:
         """Set up the server using Ansible"""
-        inventory_path = None
-        group_vars_dir = None
         try:
-            # Create Ansible inventory
-            inventory_path = self.create_ansible_inventory()
-            logger.info(f"Created inventory file at {inventory_path}")
-            
-            # Create group_vars directory and file
-            group_vars_dir = "/tmp/group_vars"
-            os.makedirs(group_vars_dir, exist_ok=True)
-            logger.info(f"Created group_vars directory at {group_vars_dir}")
-            
-            # Create group_vars/all.yml
-            group_vars_content = {
-                'anthropic_api_key': anthropic_api_key,
-                'smithery_api_key': smithery_api_key,
-                'domain_name': self.domain,
-                'agent_id_prefix': self.agent_id,
-                'github_repo': 'https://github.com/aidecentralized/nanda-agent.git',
-                'num_agents': self.num_agents,
-                'registry_url': self.registry_url
-            }
-            
-            with open(f"{group_vars_dir}/all.yml", "w") as f:
-                yaml.dump(group_vars_content, f)
-            
-            # Get the path to the local Ansible playbook
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            playbook_path = os.path.join(current_dir, "ansible", "playbook.yml")
-            logger.info(f"Using playbook at: {playbook_path}")
-            
-            # Run Ansible playbook with optional verbose output
-            verbose_flag = "-vvv" if verbose else ""
-            cmd = f"ansible-playbook -i {inventory_path} {playbook_path} {verbose_flag}"
-            logger.info(f"Running command: {cmd}")
-            stdout, stderr = self.execute_command(cmd)
-            
-            if stdout:
-                logger.info(f"Ansible playbook output: {stdout}")
-            if stderr:
-                logger.error(f"Ansible playbook error: {stderr}")
-                return False
-
-            # Check if the playbook failed by looking for "failed=1" in the output
-            if "failed=1" in stdout:
-                logger.error("Ansible playbook failed with errors")
-                return False
-                
+            # Keep all generated files in a private directory so concurrent runs don't collide
+            with tempfile.TemporaryDirectory(prefix="ioa_") as tmp_dir:
+                # Create Ansible inventory
+                inventory_path = self.create_ansible_inventory(tmp_dir)
+                logger.info(f"Created inventory file at {inventory_path}")
+
+                # Create group_vars directory next to the inventory so Ansible picks it up
+                group_vars_dir = os.path.join(tmp_dir, "group_vars")
+                os.makedirs(group_vars_dir)
+                logger.info(f"Created group_vars directory at {group_vars_dir}")
+
+                # Create group_vars/all.yml
+                group_vars_content = {
+                    'anthropic_api_key': anthropic_api_key,
+                    'smithery_api_key': smithery_api_key,
+                    'domain_name': self.domain,
+                    'agent_id_prefix': self.agent_id,
+                    'github_repo': 'https://github.com/aidecentralized/nanda-agent.git',
+                    'num_agents': self.num_agents,
+                    'registry_url': self.registry_url
+                }
+
+                with open(os.path.join(group_vars_dir, "all.yml"), "w") as f:
+                    yaml.dump(group_vars_content, f, Dumper=CSafeDumper, default_flow_style=False, sort_keys=False)
+
+                # Get the path to the local Ansible playbook
+                current_dir = os.path.dirname(os.path.abspath(__file__))
+                playbook_path = os.path.join(current_dir, "ansible", "playbook.yml")
+                logger.info(f"Using playbook at: {playbook_path}")
+
+                # Run Ansible playbook with optional verbose output
+                ansible_cmd = _find_ansible_playbook()
+                if not ansible_cmd:
+                    # Don't remember a miss, so installing Ansible later in this process is noticed
+                    _find_ansible_playbook.cache_clear()
+                    logger.error("ansible-playbook not found; install Ansible with 'pip install ansible'")
+                    return False
+
+                argv = [ansible_cmd, "-i", inventory_path, playbook_path]
+                if verbose:
+                    argv.append("-vvv")
+                # Keep Ansible's own scratch files inside the temporary directory as well
+                env = dict(os.environ,
+                           ANSIBLE_LOCAL_TEMP=os.path.join(tmp_dir, "ansible_local"),
+                           ANSIBLE_REMOTE_TEMP=os.path.join(tmp_dir, "ansible_remote"))
+                logger.info(f"Running command: {' '.join(argv)}")
+                result = self.run_command(argv, env=env)
+
+                if result.returncode != 0:
+                    logger.error(f"Ansible playbook failed with exit code {result.returncode}")
+                    return False
+
             logger.info("Server setup completed successfully")
             return True
-            
+
         except Exception as e:
             logger.error(f"Failed to setup server: {str(e)}")
             return False
-        finally:
-            # Clean up temporary files
-            if os.path.exists(inventory_path):
-                os.remove(inventory_path)
-            if os.path.exists(f"{group_vars_dir}/all.yml"):
-                os.remove(f"{group_vars_dir}/all.yml")
-            if os.path.exists(group_vars_dir):
-                os.rmdir(group_vars_dir)
-
-    def execute_command(self, command: str) -> tuple:
-        """Execute a command on the server"""
+
+    @staticmethod
+    def _stream_output(pipe, log, lines: Optional[list]) -> None:
+        """Forward each line from a pipe to the logger, optionally keeping a copy
+
+        The pipe is always drained to EOF so the child never blocks or dies on a closed pipe.
+        """
+        with pipe:
+            for line in pipe:
+                line = line.rstrip("\n")
+                if lines is not None:
+                    lines.append(line)
+                try:
+                    log(line)
+                except Exception:
+                    pass
+
+    def run_command(self, command: List[str], capture: bool = False,
+                    env: Optional[Dict[str, str]] = None) -> subprocess.CompletedProcess:
+        """Run a command on the server, streaming its output to the logger
+
+        The command is an argument list and is run without a shell.
+        stdout and stderr on the result are only collected when capture is True.
+        """
         try:
-            result = subprocess.run(command, shell=True, capture_output=True, text=True)
-            return result.stdout, result.stderr
+            process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, text=True, encoding="utf-8",
+                                       errors="replace", bufsize=1, env=env)
+            stdout_lines = [] if capture else None
+            stderr_lines = [] if capture else None
+            readers = [
+                threading.Thread(target=self._stream_output, args=(process.stdout, logger.info, stdout_lines), daemon=True),
+                threading.Thread(target=self._stream_output, args=(process.stderr, logger.warning, stderr_lines), daemon=True)
+            ]
+            for reader in readers:
+                reader.start()
+            returncode = process.wait()
+            for reader in readers:
+                reader.join()
+            return subprocess.CompletedProcess(command, returncode,
+                                               "\n".join(stdout_lines or []), "\n".join(stderr_lines or []))
         except Exception as e:
             logger.error(f"Failed to execute command: {str(e)}")
-            return "", str(e)
+            return subprocess.CompletedProcess(command, -1, "", str(e))
+
+    def execute_command(self, command: List[str]) -> tuple:
+        """Execute a command on the server and return its (stdout, stderr)"""
+        result = self.run_command(command, capture=True)
+        return result.stdout, result.stderr
 
     def setup(self, anthropic_api_key: str, smithery_api_key: str, verbose: bool = False) -> bool:
         """Complete setup process"""
@@ -195,6 +428,9 @@ def main():
     parser.add_argument('--registry-url',
                        default="https://chat.nanda-registry.com:6900",
                        help='URL of the NANDA registry (default: https://chat.nanda-registry.com:6900)')
+    parser.add_argument('--no-ip-cache',
+                       action='store_true',
+                       help='Re-detect the public IP instead of using the cached value')
 
 
     args = parser.parse_args()
@@ -217,7 +453,8 @@ def main():
         domain=args.domain, 
         agent_id=args.agent_id, 
         num_agents=args.num_agents,
-        registry_url=args.registry_url
+        registry_url=args.registry_url,
+        use_ip_cache=not args.no_ip_cache
     )
     
     if not setup.setup(args.anthropic_key, smithery_key, verbose=args.verbose):